@@ -1,11 +1,13 @@
 # A Tutorial on Structural Optimization | Sam Greydanus | 2022
-import time, nlopt                                                # for optimization
+import time, functools, nlopt                                     # for optimization
 import numpy as np                                                # for dense matrix ops
 import matplotlib.pyplot as plt                                   # for plotting
-import autograd, autograd.core, autograd.extend, autograd.tracer  # for adjoints
-import autograd.numpy as anp      
-import scipy, scipy.ndimage, scipy.sparse, scipy.sparse.linalg    # sparse matrices
-import jax.numpy as jnp
+import scipy, scipy.sparse, scipy.sparse.linalg                   # sparse matrices
+import numba                                                      # for compiled kernels
+try:
+  import sksparse.cholmod                                         # optional, fast SPD solves
+except ImportError:
+  sksparse = None
 
 ##### Problem setup #####
 class ObjectView(object):
@@ -14,17 +16,29 @@ class ObjectView(object):
 def get_args(normals, forces, density=0.4):  # Manage the problem setup parameters
   width = normals.shape[0] - 1
   height = normals.shape[1] - 1
-  fixdofs = np.flatnonzero(normals.ravel())
+  fixdofs = np.flatnonzero(normals.ravel()).astype(np.int32)  # int32 halves index traffic
   alldofs = np.arange(2 * (width + 1) * (height + 1))
-  freedofs = np.sort(list(set(alldofs) - set(fixdofs)))
+  free_mask = np.ones(alldofs.size, dtype=bool) ; free_mask[fixdofs] = False
+  freedofs = np.flatnonzero(free_mask).astype(np.int32)  # already sorted
+  edof = _get_edof(width, height)  # index maps are fixed for a given mesh, so build them once
+  coo_row, coo_col = _get_k_pattern(edof)
+  _, keep, indices = _get_dof_indices(freedofs, fixdofs, free_mask, coo_row, coo_col)
+  csc_pattern = _get_csc_pattern(indices, freedofs.size)
+  cholmod_factor = _cholmod_analyze(csc_pattern, freedofs.size) if sksparse is not None else None
+  young, poisson = 1, 0.3
   params = {
       # material properties
-      'young': 1, 'young_min': 1e-9, 'poisson': 0.3, 'g': 0,
+      'young': young, 'young_min': 1e-9, 'poisson': poisson, 'g': 0,
+      'ke': get_stiffness_matrix(young, poisson),  # element stiffness matrix (constant)
       # constraints
       'density': density, 'xmin': 0.001, 'xmax': 1.0,
       # input parameters
       'nelx': width, 'nely': height, 'mask': 1, 'penal': 3.0, 'filter_width': 1,
-      'freedofs': freedofs, 'fixdofs': fixdofs, 'forces': forces.ravel(),
+      'freedofs': freedofs, 'fixdofs': fixdofs, 'free_mask': free_mask, 'forces': forces.ravel(),
+      'free_forces': forces.ravel()[freedofs], 'n_dofs': alldofs.size,
+      # element and sparse matrix index maps
+      'edof': edof, 'coo_row': coo_row, 'coo_col': coo_col, 'keep': keep,
+      'csc_pattern': csc_pattern, 'cholmod_factor': cholmod_factor,
       # optimization parameters
       'opt_steps': 80, 'print_every': 10}
   return ObjectView(params)
@@ -44,38 +58,55 @@ def physical_density(x, args, volume_contraint=False, use_filter=True):
   x = args.mask * x.reshape(args.nely, args.nelx)  # reshape from 1D to 2D
   return gaussian_filter(x, args.filter_width) if use_filter else x  # maybe filter
 
+def physical_density_vjp(g, args, use_filter=True):  # pulls a gradient w.r.t. x_phys back to x
+  g = gaussian_filter(g, args.filter_width) if use_filter else g  # the filter is self-adjoint
+  return (args.mask * g).ravel()
+
 def mean_density(x, args, volume_contraint=False, use_filter=True):
-  return anp.mean(physical_density(x, args, volume_contraint, use_filter)) / anp.mean(args.mask)
+  return np.mean(physical_density(x, args, volume_contraint, use_filter)) / np.mean(args.mask)
+
+def mean_density_and_grad(x, args, volume_contraint=False, use_filter=True):
+  g = np.full((args.nely, args.nelx), 1 / (args.nely * args.nelx * np.mean(args.mask)))
+  return mean_density(x, args, volume_contraint, use_filter), physical_density_vjp(g, args, use_filter)
 
 ##### Optimization objective + physics of elastic materials #####
-def objective(x, args, volume_contraint=False, use_filter=True):
+def objective_and_grad(x, args, volume_contraint=False, use_filter=True):
+  # The adjoint of compliance is closed form (k is self-adjoint, the load doesn't depend on x),
+  # so compliance returns dc/dx_phys along with c and no autodiff tape is needed
   kwargs = dict(penal=args.penal, e_min=args.young_min, e_0=args.young)
   x_phys = physical_density(x, args, volume_contraint=volume_contraint, use_filter=use_filter)
-  ke     = get_stiffness_matrix(args.young, args.poisson)  # stiffness matrix
-  u      = displace(x_phys, ke, args.forces, args.freedofs, args.fixdofs, **kwargs)
-  c      = compliance(x_phys, u, ke, **kwargs)
-  return c
+  u      = displace(x_phys, args, **kwargs)
+  c, dc  = compliance(x_phys, u, args, **kwargs)
+  return c, physical_density_vjp(dc, args, use_filter=use_filter)
 
-def compliance(x_phys, u, ke, *, penal=3, e_min=1e-9, e_0=1):
-  nely, nelx = x_phys.shape
-  ely, elx = anp.meshgrid(range(nely), range(nelx))  # x, y coords for the index map
+def compliance(x_phys, u, args, *, penal=3, e_min=1e-9, e_0=1):
+  u_elem = u[args.edof]  # select from u matrix, one row per element
+  return _element_compliance(u_elem, args.ke, x_phys, e_0, e_min, penal)
 
-  n1 = (nely+1)*(elx+0) + (ely+0)  # nodes
-  n2 = (nely+1)*(elx+1) + (ely+0)
-  n3 = (nely+1)*(elx+1) + (ely+1)
-  n4 = (nely+1)*(elx+0) + (ely+1)
-  all_ixs = anp.array([2*n1, 2*n1+1, 2*n2, 2*n2+1, 2*n3, 2*n3+1, 2*n4, 2*n4+1])
-  u_selected = u[all_ixs]  # select from u matrix
-
-  ke_u = anp.einsum('ij,jkl->ikl', ke, u_selected)  # compute x^penal * U.T @ ke @ U
-  ce = anp.einsum('ijk,ijk->jk', u_selected, ke_u)
-  C = young_modulus(x_phys, e_0, e_min, p=penal) * ce.T
-  return anp.sum(C)
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _element_compliance(u_elem, ke, x_phys, e_0, e_min, penal):
+  # Fuses u_e^T ke u_e, young_modulus and the sum into one pass over the elements;
+  # also returns dc/dx_phys = -penal * x_phys^(penal-1) * (e_0-e_min) * u_e^T ke u_e
+  nely = x_phys.shape[0]
+  dc = np.empty_like(x_phys)
+  c = 0.0
+  for e in numba.prange(len(u_elem)):
+    ely, elx = e % nely, e // nely  # edof enumerates the elements column by column
+    ce = 0.0  # compute u_e.T @ ke @ u_e
+    for i in range(8):
+      ke_u = 0.0
+      for j in range(8):
+        ke_u += ke[i, j] * u_elem[e, j]
+      ce += u_elem[e, i] * ke_u
+    x_e = x_phys[ely, elx]
+    c += (e_min + x_e ** penal * (e_0 - e_min)) * ce  # young_modulus(x_e) * ce
+    dc[ely, elx] = -penal * x_e ** (penal - 1) * (e_0 - e_min) * ce
+  return c, dc
 
 def get_stiffness_matrix(e, nu):  # e=young's modulus, nu=poisson coefficient
-  k = anp.array([1/2-nu/6, 1/8+nu/8, -1/4-nu/12, -1/8+3*nu/8,
+  k = np.array([1/2-nu/6, 1/8+nu/8, -1/4-nu/12, -1/8+3*nu/8,
                 -1/4+nu/12, -1/8-nu/8, nu/6, 1/8-3*nu/8])
-  return e/(1-nu**2)*anp.array([[k[0], k[1], k[2], k[3], k[4], k[5], k[6], k[7]],
+  return e/(1-nu**2)*np.array([[k[0], k[1], k[2], k[3], k[4], k[5], k[6], k[7]],
                                [k[1], k[0], k[7], k[6], k[5], k[4], k[3], k[2]],
                                [k[2], k[7], k[0], k[5], k[6], k[3], k[4], k[1]],
                                [k[3], k[6], k[5], k[0], k[7], k[2], k[1], k[4]],
@@ -84,118 +115,172 @@ def get_stiffness_matrix(e, nu):  # e=young's modulus, nu=poisson coefficient
                                [k[6], k[3], k[4], k[1], k[2], k[7], k[0], k[5]],
                                [k[7], k[2], k[1], k[4], k[3], k[6], k[5], k[0]]])
   
-def get_k(stiffness, ke):
-  # Constructs sparse stiffness matrix k (used in the displace fn)
-  # First, get position of the nodes of each element in the stiffness matrix
-  nely, nelx = stiffness.shape
-  ely, elx = anp.meshgrid(range(nely), range(nelx))  # x, y coords
-  ely, elx = ely.reshape(-1, 1), elx.reshape(-1, 1)
+def _get_edof(nelx, nely):
+  # Gets position of the nodes of each element in the stiffness matrix (one row per element)
+  ely, elx = np.meshgrid(range(nely), range(nelx))  # x, y coords
+  ely, elx = ely.ravel(), elx.ravel()
 
   n1 = (nely+1)*(elx+0) + (ely+0)
   n2 = (nely+1)*(elx+1) + (ely+0)
   n3 = (nely+1)*(elx+1) + (ely+1)
   n4 = (nely+1)*(elx+0) + (ely+1)
-  edof = anp.array([2*n1, 2*n1+1, 2*n2, 2*n2+1, 2*n3, 2*n3+1, 2*n4, 2*n4+1])
-  edof = edof.T[0]
-  x_list = anp.repeat(edof, 8)  # flat list pointer of each node in an element
-  y_list = anp.tile(edof, 8).flatten()  # flat list pointer of each node in elem
+  # stack along the last axis so edof is C-contiguous (edof.T[0] was a strided view)
+  edof = np.stack([2*n1, 2*n1+1, 2*n2, 2*n2+1, 2*n3, 2*n3+1, 2*n4, 2*n4+1], axis=-1)
+  return edof.astype(np.int32)
 
-  # make the global stiffness matrix K
-  kd = stiffness.T.reshape(nelx*nely, 1, 1)
-  value_list = (kd * anp.tile(ke, kd.shape)).flatten()
-  return value_list, y_list, x_list
+def _get_k_pattern(edof):  # row and column of every entry of the per-element ke blocks
+  shape = (len(edof), 8, 8)
+  coo_row = np.broadcast_to(edof[:, :, None], shape).ravel()
+  coo_col = np.broadcast_to(edof[:, None, :], shape).ravel()
+  return coo_row, coo_col
+
+def get_k(stiffness, ke):
+  # Constructs the entries of sparse stiffness matrix k (indices are fixed, see get_args)
+  return np.einsum('e,ij->eij', stiffness.T.ravel(), ke).ravel()  # ke is not tiled
 
-def displace(x_phys, ke, forces, freedofs, fixdofs, *, penal=3, e_min=1e-9, e_0=1):
+def displace(x_phys, args, *, penal=3, e_min=1e-9, e_0=1):
   # Displaces the load x using finite element techniques (solve_coo=most of runtime)
   stiffness = young_modulus(x_phys, e_0, e_min, p=penal)
-  k_entries, k_ylist, k_xlist = get_k(stiffness, ke)
+  k_entries = get_k(stiffness, args.ke)
 
-  index_map, keep, indices = _get_dof_indices(freedofs, fixdofs, k_ylist, k_xlist)
-  
-  u_nonzero = solve_coo(k_entries[keep], indices, forces[freedofs], sym_pos=True)
-  u_values = anp.concatenate([u_nonzero, anp.zeros(len(fixdofs))])
-  return u_values[index_map]
+  u_nonzero = solve_coo(k_entries[args.keep], args.csc_pattern, args.free_forces, sym_pos=True,
+                        cholmod_factor=args.cholmod_factor)
+  return scatter(u_nonzero, args.freedofs, args.n_dofs)  # fixed dofs have zero displacement
   
 ##### Sparse matrix (COO) helper functions #####
-def _get_dof_indices(freedofs, fixdofs, k_xlist, k_ylist):  # sparse matrix helper function
-  index_map = inverse_permutation(anp.concatenate([freedofs, fixdofs]))
-  keep = anp.isin(k_xlist, freedofs) & anp.isin(k_ylist, freedofs)
+def _get_dof_indices(freedofs, fixdofs, free_mask, coo_row, coo_col):  # sparse matrix helper function
+  index_map = inverse_permutation(np.concatenate([freedofs, fixdofs]))
+  keep = free_mask[coo_row] & free_mask[coo_col]  # membership test by lookup, not np.isin
   # Now we index an indexing array that is being indexed by the indices of k
-  i = index_map[k_ylist][keep]
-  j = index_map[k_xlist][keep]
-  return index_map, keep, anp.stack([i, j])
+  i = index_map[coo_row][keep]
+  j = index_map[coo_col][keep]
+  return index_map, keep, np.stack([i, j])
 
 def inverse_permutation(indices):  # reverses an index operation
-  inverse_perm = np.zeros(len(indices), dtype=anp.int64)
-  inverse_perm[indices] = np.arange(len(indices), dtype=anp.int64)
+  inverse_perm = np.zeros(len(indices), dtype=np.int32)
+  inverse_perm[indices] = np.arange(len(indices), dtype=np.int32)
   return inverse_perm
 
-def _get_solver(a_entries, a_indices, size, sym_pos):
-  # a is (usu.) symmetric positive; could solve 2x faster w/sksparse.cholmod.cholesky(a).solve_A
-  a = scipy.sparse.coo_matrix((a_entries, a_indices), shape=(size,)*2).tocsc()
-  return scipy.sparse.linalg.splu(a).solve
+def _get_csc_pattern(a_indices, size):
+  # The pattern of a is fixed for a given mesh, so the COO->CSC sort is done once in get_args;
+  # slots[n] is the position of the n-th COO entry in the data array of the CSC matrix
+  i, j = a_indices
+  keys, slots = np.unique(j.astype(np.int64) * size + i, return_inverse=True)  # CSC order
+  indptr = np.concatenate([[0], np.cumsum(np.bincount(keys // size, minlength=size))])
+  return slots, (keys % size).astype(np.int32), indptr.astype(np.int32)
 
-##### Autograd custom gradients #####
-@autograd.primitive
-def solve_coo(a_entries, a_indices, b, sym_pos=False):
-  solver = _get_solver(a_entries, a_indices, b.size, sym_pos)
-  return solver(b)
+def _coo_to_csc(a_entries, csc_pattern, size):  # sums the entries into their CSC slots
+  slots, indices, indptr = csc_pattern
+  data = np.bincount(slots, weights=a_entries, minlength=len(indices))  # beats sort+reduceat
+  return scipy.sparse.csc_matrix((data, indices, indptr), shape=(size,)*2)
+
+def _cholmod_analyze(csc_pattern, size):  # symbolic Cholesky analysis, depends only on the pattern
+  a = _coo_to_csc(np.ones(len(csc_pattern[0])), csc_pattern, size)
+  if hasattr(sksparse.cholmod, 'analyze'):  # scikit-sparse < 0.5
+    return sksparse.cholmod.analyze(a)
+  return sksparse.cholmod.CholeskyFactor(a)
+
+def _cholmod_solver(factor, a):  # numeric factorization only, reuses the symbolic analysis
+  if hasattr(factor, 'cholesky_inplace'):  # scikit-sparse < 0.5
+    factor.cholesky_inplace(a)
+    return factor.solve_A
+  factor.factorize(a)
+  return factor.solve
 
-def grad_solve_coo_entries(ans, a_entries, a_indices, b, sym_pos=False):
-  def jvp(grad_ans):
-    lambda_ = solve_coo(a_entries, a_indices if sym_pos else a_indices[::-1],
-                        grad_ans, sym_pos)
-    i, j = a_indices
-    return -lambda_[i] * ans[j]
-  return jvp
+def _get_solver(a_entries, csc_pattern, size, sym_pos, cholmod_factor=None):
+  # a is (usu.) symmetric positive, so use supernodal Cholesky when CHOLMOD is installed
+  # keep a in float64: with young_min=1e-9 it is too ill-conditioned for a float32 solve
+  a = _coo_to_csc(a_entries, csc_pattern, size)  # canonical: sorted, no duplicate entries
+  if sym_pos and cholmod_factor is not None:
+    return _cholmod_solver(cholmod_factor, a)
+  if sym_pos:  # SuperLU fallback; SPD, so use a symmetric ordering and pivot on the diagonal
+    return scipy.sparse.linalg.splu(a, permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0,
+                                    options=dict(SymmetricMode=True)).solve
+  return scipy.sparse.linalg.splu(a).solve  # general fallback: SuperLU
 
-autograd.extend.defvjp(solve_coo, grad_solve_coo_entries,
-                       lambda: print('err: gradient undefined'),
-                       lambda: print('err: gradient not implemented'))
+def solve_coo(a_entries, csc_pattern, b, sym_pos=False, cholmod_factor=None):
+  solver = _get_solver(a_entries, csc_pattern, b.size, sym_pos, cholmod_factor)
+  return solver(b)
+
+def scatter(values, indices, size):  # zeros of length size, with values placed at indices
+  out = np.zeros(size, dtype=values.dtype)
+  np.put(out, indices, values)
+  return out
 
-@autograd.extend.primitive
+##### Density filter #####
 def gaussian_filter(x, width): # 2D gaussian blur/filter
-  return scipy.ndimage.gaussian_filter(x, width, mode='reflect')
+  return _gaussian_filter2d(np.ascontiguousarray(x, dtype=np.float64), _gaussian_kernel1d(width))
+
+@functools.lru_cache()
+def _gaussian_kernel1d(sigma, truncate=4.0):  # same taps as scipy.ndimage.gaussian_filter
+  radius = int(truncate * sigma + 0.5)
+  phi = np.exp(-0.5 / sigma**2 * np.arange(-radius, radius+1)**2)
+  return phi / phi.sum()
+
+@numba.njit(cache=True)
+def _reflect(i, n):  # scipy.ndimage's mode='reflect': (d c b a | a b c d | d c b a)
+  while i < 0 or i >= n:
+    i = -i - 1 if i < 0 else 2*n - i - 1
+  return i
 
-def _gaussian_filter_vjp(ans, x, width): # gives the gradient of orig. function w.r.t. x
-  del ans, x  # unused
-  return lambda g: gaussian_filter(g, width)
-autograd.extend.defvjp(gaussian_filter, _gaussian_filter_vjp)
+@numba.njit(cache=True, fastmath=True)
+def _gaussian_filter2d(x, weights):  # separable: a 1D pass along axis 0, then along axis 1
+  radius = len(weights) // 2
+  nely, nelx = x.shape
+  tmp, out = np.empty_like(x), np.empty_like(x)
+  for i in range(nely):
+    for j in range(nelx):
+      acc = 0.0
+      for k in range(-radius, radius+1):
+        acc += weights[k+radius] * x[_reflect(i+k, nely), j]
+      tmp[i, j] = acc
+  for i in range(nely):
+    for j in range(nelx):
+      acc = 0.0
+      for k in range(-radius, radius+1):
+        acc += weights[k+radius] * tmp[i, _reflect(j+k, nelx)]
+      out[i, j] = acc
+  return out
 
 ##### Main optimization function #####
 def fast_stopt(args, x=None, verbose=True):
   if x is None:
-    x = jnp.ones((args.nely, args.nelx)) * args.density  # init mass
+    x = np.ones((args.nely, args.nelx)) * args.density  # init mass
 
   reshape = lambda x: x.reshape(args.nely, args.nelx)
-  objective_fn = lambda x: objective(reshape(x), args) # don't enforce mass constraint here
-  constraint = lambda params: mean_density(reshape(params), args) - args.density
+  objective_fn = lambda x: objective_and_grad(reshape(x), args) # don't enforce mass constraint here
+  def constraint(params):
+    value, grad = mean_density_and_grad(reshape(params), args)
+    return value - args.density, grad
   
-  def wrap_autograd_func(func, losses=None, frames=None):
+  def wrap_func(func, losses=None, frames=None):  # func returns (value, gradient)
     def wrapper(x, grad):
+      value, dvalue = func(x)
       if grad.size > 0:
-        value, grad[:] = autograd.value_and_grad(func)(x)
-      else:
-        value = func(x)
-      if losses is not None:
-        losses.append(value)
-      if frames is not None:
-        frames.append(reshape(x).copy())
-        if verbose and len(frames) % args.print_every == 0:
-          print('step {}, loss {:.2e}, t={:.2f}s'.format(len(frames), value, time.time()-dt))
+        grad[:] = dvalue
+      if losses is not None or frames is not None:  # preallocated buffers, filled in place
+        i = step[0] ; step[0] += 1
+        if losses is not None:
+          losses[i] = value
+        if frames is not None:
+          frames[i] = reshape(x)
+        if verbose and (i + 1) % args.print_every == 0:
+          print('step {}, loss {:.2e}, t={:.2f}s'.format(i + 1, value, time.perf_counter()-dt))
       return value
     return wrapper
 
-  losses, frames = [], [] ; dt = time.time()
-  import pdb; pdb.set_trace()
+  max_evals = args.opt_steps + 1
+  losses, frames = np.empty(max_evals), np.empty((max_evals, args.nely, args.nelx))
+  step = np.zeros(1, dtype=int) ; dt = time.perf_counter()  # step counts objective calls
   print('Optimizing a problem with {} nodes'.format(len(args.forces)))
   opt = nlopt.opt(nlopt.LD_MMA, x.size)
   opt.set_lower_bounds(0.0) ; opt.set_upper_bounds(1.0)
-  opt.set_min_objective(wrap_autograd_func(objective_fn, losses, frames))
-  opt.add_inequality_constraint(wrap_autograd_func(constraint), 1e-8)
-  opt.set_maxeval(args.opt_steps + 1)
+  opt.set_min_objective(wrap_func(objective_fn, losses, frames))
+  opt.add_inequality_constraint(wrap_func(constraint), 1e-8)
+  opt.set_maxeval(max_evals)
   opt.optimize(x.flatten())
-  return np.array(losses), reshape(frames[-1]), np.array(frames)
+  n = step[0]
+  return losses[:n], frames[n-1] if n else reshape(x), frames[:n]  # n == 0: nlopt made no calls
 
 ##### Run the simulation and visualize the result #####
 args = get_args(*mbb_beam())